@@ -1,11 +1,20 @@
 # Path: testing/tests/helper_test.py
 
-import json
+import functools
 import sys
 import os
+import re
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+# orjson is optional; both parsers raise ValueError subclasses on bad input.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 COLOR_RESET = "\033[0m"
 COLOR_GREEN = "\033[32m"
 COLOR_BOLD = "\033[1m"
@@ -15,42 +24,80 @@ COLOR_RED = "\033[31m"
 COLOR_BLINK = "\033[5m"
 
 BASE_DIR = Path(__file__).parent.parent
+ARGS_DIR = BASE_DIR / "args"
+
+# Upper bound on concurrent dfx invocations for parallel cleanups/template writes.
+MAX_WORKERS = 8
+
+# Guards writes to deployed_canisters from worker threads.
+_deployed_lock = threading.Lock()
+
+# Serializes dfx commands that rewrite project state (.dfx/<network>/canister_ids.json),
+# which dfx does not coordinate between concurrent processes.
+_dfx_state_lock = threading.Lock()
 
-def run_command(command, desc=None, capture_output=False):
+# Textual canister id, e.g. "bkyz2-fmaaa-aaaaa-qaaaq-cai".
+_CANISTER_ID_RE = re.compile(r"\b[a-z2-7]{5}(?:-[a-z2-7]{5}){3}-cai\b")
+
+# Cached result of 'dfx identity whoami'; see get_caller_identity().
+_caller_identity = None
+
+def run_command(argv, desc=None, capture_output=False, identity=None):
     """
-    Runs a shell command (with shell=True). Optionally prints 'desc' before running,
+    Runs a command given as an argv list (no shell). Optionally prints 'desc' before running,
     and captures the command's stdout if capture_output=True.
+    If 'identity' is given, a ["dfx", ...] command runs as 'dfx --identity <identity> ...',
+    leaving the globally selected dfx identity untouched.
 
     Returns:
       (bool, str)
       - bool = True if command succeeded (exit code 0), else False.
-      - str   = captured stdout if capture_output=True, otherwise "".
+      - str   = captured stdout if capture_output=True, otherwise "" (the command's
+                output then goes directly to this process's stdout).
     """
+    if identity and argv[0] == "dfx":
+        argv = ["dfx", "--identity", identity] + list(argv[1:])
     if desc:
         print(f"\n{COLOR_BOLD}==== {desc} ===={COLOR_RESET}\n")
     try:
-        proc = subprocess.Popen(
-            command, shell=True,
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
-        )
-        lines = []
-        for line in iter(proc.stdout.readline, ""):
-            print(line, end="")
-            if capture_output:
-                lines.append(line)
-        proc.stdout.close()
-        code = proc.wait()
-        if code != 0:
-            print(f"{COLOR_BOLD}COMMAND FAILED WITH RETURN CODE {code}{COLOR_RESET}")
-            return False, "".join(lines)
-        return True, "".join(lines) if capture_output else ""
+        if capture_output:
+            proc = subprocess.run(
+                argv,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+            )
+            output = proc.stdout
+            print(output, end="")
+        else:
+            # The child writes straight to our stdout; flush first to keep ordering.
+            sys.stdout.flush()
+            proc = subprocess.run(argv, stdout=None, stderr=subprocess.STDOUT)
+            output = ""
+        if proc.returncode != 0:
+            print(f"{COLOR_BOLD}COMMAND FAILED WITH RETURN CODE {proc.returncode}{COLOR_RESET}")
+            return False, output
+        return True, output
     except Exception as e:
         print(f"{COLOR_BOLD}UNEXPECTED ERROR OCCURRED: {e}{COLOR_RESET}")
         return False, ""
 
+def get_caller_identity():
+    """
+    Returns the identity selected in dfx when the script started ('dfx identity whoami').
+    The lookup runs at most once; dfx commands use '--identity' instead of switching, so
+    the cached name stays valid. Returns "" if the lookup fails.
+    """
+    global _caller_identity
+    if _caller_identity is None:
+        ok_who, out_who = run_command(["dfx", "identity", "whoami"], capture_output=True)
+        if not ok_who:
+            return ""
+        _caller_identity = out_who.strip()
+    return _caller_identity
+
 def parse_json_and_init_data():
     """
-    Parses JSON from sys.argv[1]. Returns:
+    Parses the input JSON, taken from the file named by sys.argv[1], from sys.argv[1] itself,
+    or from stdin when no argument is given and stdin is not a terminal. Returns:
       (success, all_canisters, selected_canister, counters, created_identities, deployed_canisters, template_vars)
 
     success (bool) indicates if JSON parse was okay.
@@ -61,10 +108,20 @@ def parse_json_and_init_data():
     deployed_canisters (dict): { "canister_name": { "canister_id": "<pid>" } }
     template_vars (dict): e.g. { "owner_principal": ... }
     """
-    if len(sys.argv) != 2:
+    if len(sys.argv) == 2:
+        source = sys.argv[1]
+    elif len(sys.argv) == 1 and sys.stdin is not None and not sys.stdin.isatty():
+        source = None
+    else:
         return False, {}, "", {}, {}, {}, {}
     try:
-        data = json.loads(sys.argv[1])
+        if source is None:
+            raw = sys.stdin.buffer.read()
+        elif os.path.isfile(source):
+            raw = Path(source).read_bytes()
+        else:
+            raw = source
+        data = _json.loads(raw)
         all_cans = data.get("canisters", {})
         sel = data.get("selected_canister", "")
         counters = {"total": 0, "success": 0, "failed": 0, "id": 1}
@@ -72,53 +129,42 @@ def parse_json_and_init_data():
         deployed_canisters = {}
         template_vars = {}
         return True, all_cans, sel, counters, created_identities, deployed_canisters, template_vars
-    except:
+    except (ValueError, AttributeError, OSError):
+        # ValueError covers JSONDecodeError and UnicodeDecodeError from non-UTF-8 bytes.
         return False, {}, "", {}, {}, {}, {}
 
 def create_identity(name, created_identities):
     """
     Creates a new identity 'name', storing principal in created_identities[name].
-    Reverts to the original caller identity afterward.
+    The principal is read with 'dfx --identity', so the caller identity is never switched.
 
     Returns True if successful, else False.
     """
-    ok_who, out_who = run_command("dfx identity whoami", capture_output=True)
-    original = out_who.strip() if ok_who else ""
-    ok_new, _ = run_command(f"dfx identity new {name}", desc=f"Create identity '{name}'")
+    ok_new, _ = run_command(["dfx", "identity", "new", name], desc=f"Create identity '{name}'")
     if not ok_new:
         return False
-    ok_use, _ = run_command(f"dfx identity use {name}", desc=f"Switch to identity '{name}'")
-    if not ok_use:
-        if original:
-            run_command(f"dfx identity use {original}")
-        return False
-    ok_pr, out_pr = run_command("dfx identity get-principal", capture_output=True)
+    ok_pr, out_pr = run_command(["dfx", "identity", "get-principal"], capture_output=True, identity=name)
     if not ok_pr:
-        if original:
-            run_command(f"dfx identity use {original}")
         return False
     created_identities[name] = out_pr.strip()
-    if original:
-        run_command(f"dfx identity use {original}", desc=f"Revert to identity '{original}'")
     return True
 
 def remove_identity(identity_name, created_identities):
     """
-    Switches to default identity, removes 'identity_name', reverts to original caller, 
-    and removes from created_identities. Returns True if everything ok, else False.
+    Removes 'identity_name' and drops it from created_identities. The selected dfx identity
+    is only switched (to default) if 'identity_name' is the caller identity, since dfx
+    refuses to remove the identity in use. Returns True if everything ok, else False.
     """
-    ok_who, out_who = run_command("dfx identity whoami", capture_output=True)
-    caller_identity = out_who.strip() if ok_who else ""
-    ok_def, _ = run_command("dfx identity use default", desc="Switch to 'default' for identity removal")
-    if not ok_def:
-        if caller_identity:
-            run_command(f"dfx identity use {caller_identity}")
-        return False
-    if identity_name in created_identities:
-        run_command(f"dfx identity remove {identity_name}", desc=f"Remove identity '{identity_name}'")
-        created_identities.pop(identity_name, None)
-    if caller_identity:
-        run_command(f"dfx identity use {caller_identity}", desc=f"Revert to identity '{caller_identity}'")
+    global _caller_identity
+    if identity_name not in created_identities:
+        return True
+    if identity_name == get_caller_identity():
+        ok_def, _ = run_command(["dfx", "identity", "use", "default"], desc="Switch to 'default' for identity removal")
+        if not ok_def:
+            return False
+        _caller_identity = "default"
+    run_command(["dfx", "identity", "remove", identity_name], desc=f"Remove identity '{identity_name}'")
+    created_identities.pop(identity_name, None)
     return True
 
 def remove_all_identities(created_identities):
@@ -127,162 +173,202 @@ def remove_all_identities(created_identities):
     Returns True if no major failures, else False.
     """
     all_ok = True
-    names = list(created_identities.keys())
+    names = [n for n in created_identities if n != "default"]
     for nm in names:
-        if nm == "default":
-            continue
         ok = remove_identity(nm, created_identities)
         if not ok:
             all_ok = False
     return all_ok
 
-def write_init_args(template_path, vars_dict):
+@functools.lru_cache(maxsize=32)
+def _placeholder_re(keys):
     """
-    Reads file at template_path, replaces {k} with vars_dict[k], writes to 'args/<stem>.candid'.
-    Returns True if success, else False.
+    Returns a regex matching "{k}" for every k in 'keys' (a tuple), taken literally.
+    """
+    return re.compile(r"\{(" + "|".join(map(re.escape, keys)) + r")\}")
+
+def write_init_args(template_path, vars_dict, out_dir=None):
+    """
+    Reads file at template_path, replaces every "{k}" with vars_dict[k] (a str or int) for each key k,
+    taken literally (other placeholders are left as-is), writes to '<out_dir>/<stem>.candid'.
+    A single variable is substituted with str.replace, several with one regex pass.
+    out_dir must already exist; if omitted, 'args/' is used and created if needed.
+    Returns True if success, else False (including when a value is not a str or int).
     """
     if not os.path.exists(template_path):
         return False
+    cstem = Path(template_path).stem
     try:
-        cstem = Path(template_path).stem
-        with open(template_path, "r") as f:
-            content = f.read()
-        for k, v in vars_dict.items():
-            content = content.replace(f"{{{k}}}", v)
-        d = BASE_DIR / "args"
-        d.mkdir(exist_ok=True)
-        out_file = d / f"{cstem}.candid"
-        with open(out_file, "w") as g:
-            g.write(content)
-        return True
-    except:
+        content = Path(template_path).read_text()
+    except (OSError, ValueError):
         return False
+    # Only str and int values render as valid Candid; bool/None/etc. would write Python reprs.
+    if any(type(v) not in (str, int) for v in vars_dict.values()):
+        return False
+    if len(vars_dict) == 1:
+        # Common case (just owner_principal): a plain replace needs no regex scan.
+        k, v = next(iter(vars_dict.items()))
+        content = content.replace(f"{{{k}}}", str(v))
+    elif vars_dict:
+        content = _placeholder_re(tuple(vars_dict)).sub(lambda m: str(vars_dict[m.group(1)]), content)
+    try:
+        if out_dir is None:
+            out_dir = ARGS_DIR
+            out_dir.mkdir(exist_ok=True)
+        (out_dir / f"{cstem}.candid").write_text(content)
+    except OSError:
+        return False
+    return True
 
 def process_templates(all_canisters, template_vars):
     """
     For each canister, if 'template_path' is present and valid, writes its .candid file 
-    by substituting placeholders from template_vars.
+    by substituting placeholders from template_vars. Several templates are written in parallel.
 
     Returns True if all successful, else False if any fail.
     """
-    all_ok = True
-    for cname, cfg in all_canisters.items():
+    tasks = []
+    for cfg in all_canisters.values():
         tpath = cfg.get("template_path")
         if tpath and os.path.exists(tpath):
-            ok = write_init_args(tpath, template_vars)
-            if not ok:
-                all_ok = False
+            tasks.append((tpath, template_vars))
+    if not tasks:
+        return True
+    try:
+        ARGS_DIR.mkdir(exist_ok=True)
+    except OSError:
+        return False
+    if len(tasks) == 1:
+        return write_init_args(tasks[0][0], tasks[0][1], ARGS_DIR)
+
+    all_ok = True
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(tasks))) as pool:
+        futures = [pool.submit(write_init_args, tpath, tvars, ARGS_DIR) for tpath, tvars in tasks]
+        for fut in as_completed(futures):
+            all_ok &= fut.result()
     return all_ok
 
 def cleanup(canister_id):
     """
-    Switches to default identity, stops/uninstalls/deletes canister_id, then reverts to caller identity.
+    Stops/uninstalls/deletes canister_id as the default identity (via 'dfx --identity default').
+    The delete, which rewrites dfx's canister_ids.json, runs under _dfx_state_lock.
+
+    Returns True if all three commands succeeded, else False.
     """
-    ok_who, out_who = run_command("dfx identity whoami", capture_output=True)
-    original = out_who.strip() if ok_who else ""
-    run_command("dfx identity use default", desc=f"Switch to default for cleanup of '{canister_id}'")
-    run_command(f"dfx canister stop {canister_id}")
-    run_command(f"dfx canister uninstall-code {canister_id}")
-    run_command(f"dfx canister delete {canister_id}")
-    if original:
-        run_command(f"dfx identity use {original}", desc=f"Revert to '{original}' after cleanup")
+    ok_stop, _ = run_command(["dfx", "canister", "stop", canister_id], desc=f"Clean up '{canister_id}' as default", identity="default")
+    ok_uni, _ = run_command(["dfx", "canister", "uninstall-code", canister_id], identity="default")
+    with _dfx_state_lock:
+        ok_del, _ = run_command(["dfx", "canister", "delete", canister_id], identity="default")
+    return ok_stop and ok_uni and ok_del
 
-def deploy_canister(can_name, all_canisters, deployed_canisters):
+def parse_canister_ids(output):
     """
-    Preserves caller identity. Switches to default identity to create/build/install the canister.
-    If .candid file is found, uses it. On success, deployed_canisters[can_name] = { "canister_id": <pid> }.
+    Extracts canister ids from the URL listing printed by 'dfx deploy'
+    (e.g. "can_name: http://127.0.0.1:4943/?canisterId=<candid-ui>&id=<pid>").
+    The listing covers the requested canister and any dependencies it deployed.
 
-    Returns True if success, else False.
+    Returns { "canister_name": "<pid>" } for every listed canister.
     """
-    ok_who, out_who = run_command("dfx identity whoami", capture_output=True)
-    caller_ident = out_who.strip() if ok_who else ""
+    ids = {}
+    for line in output.splitlines():
+        name, sep, rest = line.strip().partition(": ")
+        if sep and name and " " not in name:
+            found = _CANISTER_ID_RE.findall(rest)
+            if found:
+                ids[name] = found[-1]
+    return ids
 
-    ok_def, _ = run_command("dfx identity use default", desc=f"Switch to default to deploy '{can_name}'")
-    if not ok_def:
-        if caller_ident:
-            run_command(f"dfx identity use {caller_ident}")
-        return False
+def deploy_canister(can_name, all_canisters, deployed_canisters):
+    """
+    Creates/builds/installs the canister with a single 'dfx deploy' as the default identity
+    (via 'dfx --identity default'), so the caller identity is never switched.
+    The 'dfx deploy' itself holds _dfx_state_lock, so concurrent callers cannot race on
+    dfx's canister_ids.json or on shared dependencies. If .candid file is found, uses it.
+    On success, deployed_canisters[can_name] = { "canister_id": <pid> }, plus an entry for every
+    dependency 'dfx deploy' brought up, so teardown removes those too. After a failed deploy
+    only can_name is cleaned up (if it was created); dependencies it created are left behind.
 
+    Returns True if success, else False.
+    """
     tpath = all_canisters.get(can_name, {}).get("template_path")
     arg_file = None
     if tpath and os.path.exists(tpath):
         cstem = Path(tpath).stem
-        candidate = BASE_DIR / "args" / f"{cstem}.candid"
+        candidate = ARGS_DIR / f"{cstem}.candid"
         if candidate.exists():
             arg_file = str(candidate)
 
-    ok_cre, _ = run_command(f"dfx canister create {can_name}", desc=f"Create canister {can_name}")
-    if not ok_cre:
-        if caller_ident:
-            run_command(f"dfx identity use {caller_ident}")
-        return False
-
-    ok_bld, _ = run_command(f"dfx build {can_name}", desc=f"Build canister {can_name}")
-    if not ok_bld:
-        cleanup(can_name)
-        if caller_ident:
-            run_command(f"dfx identity use {caller_ident}")
-        return False
-
+    deploy_argv = ["dfx", "deploy", can_name]
     if arg_file and os.path.exists(arg_file):
-        install_cmd = f'dfx canister install {can_name} --argument "$(cat {arg_file})"'
-    else:
-        install_cmd = f"dfx canister install {can_name}"
-
-    ok_inst, _ = run_command(install_cmd, desc=f"Install canister {can_name}")
-    if not ok_inst:
-        cleanup(can_name)
-        if caller_ident:
-            run_command(f"dfx identity use {caller_ident}")
-        return False
-
-    ok_id, out_id = run_command(f"dfx canister id {can_name}", capture_output=True)
-    if not ok_id:
-        cleanup(can_name)
-        if caller_ident:
-            run_command(f"dfx identity use {caller_ident}")
+        deploy_argv += ["--argument-file", arg_file]
+
+    with _dfx_state_lock:
+        ok_dep, out_dep = run_command(deploy_argv, desc=f"Deploy canister {can_name}", capture_output=True, identity="default")
+    if not ok_dep:
+        # Only clean up if the deploy got as far as creating the canister.
+        ok_id, _ = run_command(["dfx", "canister", "id", can_name], capture_output=True, identity="default")
+        if ok_id:
+            cleanup(can_name)
         return False
 
-    pid = out_id.strip()
-    deployed_canisters[can_name] = {"canister_id": pid}
+    ids = parse_canister_ids(out_dep)
+    if can_name not in ids:
+        ok_id, out_id = run_command(["dfx", "canister", "id", can_name], capture_output=True, identity="default")
+        if not ok_id:
+            return False
+        ids[can_name] = out_id.strip()
 
-    if caller_ident:
-        run_command(f"dfx identity use {caller_ident}", desc=f"Revert to caller identity '{caller_ident}'")
+    with _deployed_lock:
+        for name, pid in ids.items():
+            deployed_canisters[name] = {"canister_id": pid}
     return True
 
-def remove_all_canisters(deployed_canisters):
+def remove_all_canisters(deployed_canisters, all_canisters=None):
     """
-    Calls cleanup for each canister in deployed_canisters. 
-    Each cleanup uses default identity, then returns to original caller.
-
-    Returns True if no major failures, else False.
+    Removes every canister in deployed_canisters as the default identity.
+    If all_canisters is given and every one of them was deployed, a single
+    'dfx canister stop --all' / 'dfx canister delete --all' pair is used.
+    Otherwise (or if that fails) cleanup runs for each canister, concurrently;
+    stops/uninstalls overlap while the deletes are serialized.
+
+    Returns False if the canisters could not all be removed, else True. A failed '--all'
+    attempt only counts if the per-canister fallback fails too.
     """
     all_ok = True
-    can_list = list(deployed_canisters.keys())
-    for c in can_list:
-        try:
-            cleanup(c)
-        except:
-            all_ok = False
+    can_list = tuple(deployed_canisters)
+    if can_list and all_canisters and all_canisters.keys() <= deployed_canisters.keys():
+        ok_stop, _ = run_command(["dfx", "canister", "stop", "--all"], desc="Stop all canisters as default", identity="default")
+        with _dfx_state_lock:
+            ok_del = ok_stop and run_command(["dfx", "canister", "delete", "--all", "--yes"], identity="default")[0]
+        if ok_del:
+            can_list = ()
+    if can_list:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(can_list))) as pool:
+            results = list(pool.map(cleanup, can_list))
+        all_ok = all(results)
     deployed_canisters.clear()
     return all_ok
 
 def validate_output(desc, actual, expected, counters):
     """
-    Compares actual vs. expected, updates counters, prints result.
+    Compares actual vs. expected, updates counters, prints result with a single write.
     """
     counters["total"] += 1
     tid = counters["id"]
     if actual == expected:
-        print(f"\n{COLOR_GREEN}^^^^^^^^^^^^^^^^^^ TEST {tid} SUCCESSFUL ^^^^^^^^^^^^^^^^^^{COLOR_RESET}")
-        print(f"{COLOR_GREEN}{desc}{COLOR_RESET}")
-        print(f"{COLOR_GREEN}========================================================{COLOR_RESET}\n")
+        sys.stdout.write(
+            f"\n{COLOR_GREEN}^^^^^^^^^^^^^^^^^^ TEST {tid} SUCCESSFUL ^^^^^^^^^^^^^^^^^^{COLOR_RESET}\n"
+            f"{COLOR_GREEN}{desc}{COLOR_RESET}\n"
+            f"{COLOR_GREEN}========================================================{COLOR_RESET}\n\n"
+        )
         counters["success"] += 1
     else:
-        print(f"\n{COLOR_BOLD}^^^^^^^^^^^^^^^^^^ TEST {tid} FAILED ^^^^^^^^^^^^^^^^^^{COLOR_RESET}")
-        print(f"{COLOR_BOLD}{desc}{COLOR_RESET}")
-        print(f"{COLOR_BOLD}Expected: {expected}, Got: {actual}{COLOR_RESET}")
-        print(f"{COLOR_BOLD}========================================================{COLOR_RESET}\n")
+        sys.stdout.write(
+            f"\n{COLOR_BOLD}^^^^^^^^^^^^^^^^^^ TEST {tid} FAILED ^^^^^^^^^^^^^^^^^^{COLOR_RESET}\n"
+            f"{COLOR_BOLD}{desc}{COLOR_RESET}\n"
+            f"{COLOR_BOLD}Expected: {expected}, Got: {actual}{COLOR_RESET}\n"
+            f"{COLOR_BOLD}========================================================{COLOR_RESET}\n\n"
+        )
         counters["failed"] += 1
     counters["id"] += 1
 
@@ -321,7 +407,7 @@ def main():
     print(f"{COLOR_RED}Tests Failed: {counters['failed']}{COLOR_RESET}")
     print(f"{COLOR_BOLD}{COLOR_YELLOW}Total Tests: {counters['total']}{COLOR_RESET}")
 
-    ok_rmc = remove_all_canisters(deployed_cans)
+    ok_rmc = remove_all_canisters(deployed_cans, all_cans)
     if not ok_rmc:
         print(f"{COLOR_BOLD}{COLOR_RED}WARNING: remove_all_canisters encountered an error.{COLOR_RESET}")
 